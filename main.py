@@ -1,33 +1,55 @@
 import os
+import types
 import logging
+import logging.handlers
+import atexit
 from datetime import datetime
 import config
-from utils.audio_utils import monitor_audio, save_audio, list_audio_devices
-from utils.whisper_utils import transcribe_audio, save_transcription
+from utils.audio_utils import monitor_audio, save_audio, list_audio_devices, audio_rms, wav_duration
+from utils.whisper_utils import transcribe_audio_batch, save_transcription, get_batched_pipeline
 from utils.lm_studio_utils import generate_prompt, save_prompt, reset_lm_studio_instance
 from utils.comfyui_utils import ComfyUI
 import time
 import signal
 from contextlib import contextmanager
 import threading
-from queue import Queue
+import multiprocessing
+from queue import Queue, Empty, Full
 import concurrent.futures
 
+# Whisper worker processes are spawned, not forked: forking after the audio I/O
+# and stage threads have started can deadlock the child
+_mp_context = multiprocessing.get_context('spawn')
+
+# Queue read by the logging listener; also used by the Whisper worker process
+_log_queue = None
+
 # Configure logging
 def setup_logging():
     """Set up unified logging configuration"""
+    global _log_queue
     # Create log directory
     log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
     os.makedirs(log_dir, exist_ok=True)
     
+    # File and console output are written by a listener thread, so logging
+    # calls only enqueue records and never block on disk I/O
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(os.path.join(log_dir, 'app.log'), encoding='utf-8')
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    # The same process-safe queue also carries the Whisper worker process's records
+    _log_queue = _mp_context.Queue(-1)
+    listener = logging.handlers.QueueListener(_log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
     # Configure root logger
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(os.path.join(log_dir, 'app.log'), encoding='utf-8'),
-            logging.StreamHandler()
-        ]
+        handlers=[logging.handlers.QueueHandler(_log_queue)]
     )
     
     # Set log levels for other modules
@@ -36,231 +58,478 @@ def setup_logging():
     logging.getLogger('PIL').setLevel(logging.WARNING)
     
     # Disable logging configuration for other modules
-    for module in ['utils.audio_utils', 'utils.whisper_utils', 'utils.lm_studio_utils', 'utils.comfyui_utils']:
+    for module in ['utils.audio_utils', 'utils.whisper_utils', 'utils.lm_studio_utils', 'utils.comfyui_utils', 'utils.file_utils']:
         module_logger = logging.getLogger(module)
         module_logger.propagate = True
         module_logger.handlers = []
 
-# Set up logging
-setup_logging()
 logger = logging.getLogger(__name__)
 
+# Set by Ctrl+C; workers and retry backoffs wake up immediately when it is set
+_shutdown = threading.Event()
+
+# ComfyUI client, reused across images and rebuilt after an error
+_comfy_client = None
+
+def get_comfy():
+    """Get the shared ComfyUI client (created on first use)"""
+    global _comfy_client
+    if _comfy_client is None:
+        _comfy_client = ComfyUI(config.COMFYUI_CONFIG)
+    return _comfy_client
+
+# Output directory paths, filled in by setup_directories
+PATHS = types.SimpleNamespace()
+
 def setup_directories():
     """Set up necessary directories"""
-    for dir_name in [config.OUTPUT_CONFIG['audio_dir'], 
-                    config.OUTPUT_CONFIG['text_dir'], 
-                    config.OUTPUT_CONFIG['image_dir']]:
-        full_path = os.path.join(config.OUTPUT_CONFIG['base_dir'], dir_name)
+    base_dir = config.OUTPUT_CONFIG['base_dir']
+    PATHS.audio = os.path.join(base_dir, config.OUTPUT_CONFIG['audio_dir'])
+    PATHS.text = os.path.join(base_dir, config.OUTPUT_CONFIG['text_dir'])
+    PATHS.image = os.path.join(base_dir, config.OUTPUT_CONFIG['image_dir'])
+    for full_path in [PATHS.audio, PATHS.text, PATHS.image]:
         os.makedirs(full_path, exist_ok=True)
         logger.info(f"Created directory: {full_path}")
 
-def process_audio_to_image(audio_file):
-    """Process the complete flow from audio to image"""
-    try:
-        # 3. Transcribe audio (add timeout mechanism)
-        transcription = None
-        timeout_occurred = False
-        max_retries = 3
-        retry_count = 0
+# Whisper runs in a separate process so a hung transcription can be killed
+_whisper_pool = None
+# PID of the Whisper worker process, reported by the worker itself
+_whisper_pid = None
 
-        def timeout_handler():
-            nonlocal timeout_occurred
-            timeout_occurred = True
-            logger.warning("Transcription process timed out, preparing to retry")
+def _init_whisper_worker(log_queue, whisper_config):
+    """Whisper worker process initializer: route logs to the main process and load the model"""
+    # Ctrl+C is handled by the main process, which stops this worker itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    get_batched_pipeline(whisper_config)
 
-        while retry_count < max_retries:
-            timeout_occurred = False
-            timer = threading.Timer(120, timeout_handler)
-            timer.start()
+def _whisper_worker_ready():
+    """Return the worker's PID; completes once the initializer has loaded the model"""
+    return os.getpid()
 
+def _wait_result(future, timeout):
+    """Wait for a future in 1-second slices
+
+    Raises KeyboardInterrupt as soon as shutdown is requested, and
+    concurrent.futures.TimeoutError once timeout seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if _shutdown.is_set():
+            raise KeyboardInterrupt
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise concurrent.futures.TimeoutError
+        try:
+            return future.result(timeout=min(1, remaining))
+        except concurrent.futures.TimeoutError:
+            continue
+
+def start_whisper_pool():
+    """Start the Whisper worker process and wait until it has loaded the model
+
+    Loading (and downloading on first run) can take minutes, so it is waited for
+    here without a deadline rather than inside a transcription timeout.
+    """
+    global _whisper_pool, _whisper_pid
+    logger.info("Starting Whisper worker and loading model...")
+    start_time = time.monotonic()
+    _whisper_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=_mp_context,
+        initializer=_init_whisper_worker,
+        initargs=(_log_queue, config.WHISPER_CONFIG)
+    )
+    try:
+        # No deadline, but Ctrl+C is still noticed during a long load
+        _whisper_pid = _wait_result(_whisper_pool.submit(_whisper_worker_ready), float('inf'))
+    except BaseException:
+        # Don't leave a half-started worker behind (Ctrl+C, BrokenProcessPool, ...)
+        stop_whisper_pool()
+        raise
+    logger.info(f"Whisper worker ready in {time.monotonic() - start_time:.1f} seconds")
+    return _whisper_pool
+
+def get_whisper_pool():
+    """Get the Whisper worker process pool, restarting it if it was killed"""
+    if _whisper_pool is None:
+        return start_whisper_pool()
+    return _whisper_pool
+
+def stop_whisper_pool():
+    """Kill the Whisper worker process and drop the pool (it is restarted on next use)"""
+    global _whisper_pool, _whisper_pid
+    if _whisper_pool is not None:
+        # shutdown() alone waits for the running task, so kill the worker first
+        if _whisper_pid is not None:
             try:
-                logger.info(f"Starting audio transcription... (Attempt {retry_count + 1}/{max_retries})")
-                transcription = transcribe_audio(audio_file, config.WHISPER_CONFIG)
+                os.kill(_whisper_pid, signal.SIGTERM)
+            except OSError:
+                pass  # Already exited
+        else:
+            # Still loading, so the PID isn't known yet
+            for process in _mp_context.active_children():
+                process.terminate()
+        _whisper_pool.shutdown(wait=False, cancel_futures=True)
+        _whisper_pool = None
+        _whisper_pid = None
+
+def transcribe_audio_files(audio_files):
+    """Transcribe a batch of audio files with timeout and retries"""
+    # 3. Transcribe audio (add timeout mechanism)
+    transcriptions = None
+    # Allow a fixed overhead plus time proportional to the amount of audio
+    audio_seconds = sum(wav_duration(audio_file) for audio_file in audio_files)
+    timeout = (config.WHISPER_CONFIG.get('timeout', 120)
+               + config.WHISPER_CONFIG.get('timeout_per_audio_second', 2.0) * audio_seconds)
+    max_retries = 3
+    retry_count = 0
+
+    while retry_count < max_retries:
+        try:
+            # Make sure the model is loaded before the timeout starts counting
+            pool = get_whisper_pool()
+            logger.info(f"Starting audio transcription of {len(audio_files)} file(s)... (Attempt {retry_count + 1}/{max_retries})")
+            future = pool.submit(transcribe_audio_batch, audio_files, config.WHISPER_CONFIG)
+            transcriptions = _wait_result(future, timeout)
                 
-                if timeout_occurred:
-                    raise TimeoutError("Transcription process timed out (exceeded 120 seconds)")
-                    
-                if not transcription:
-                    raise Exception("Audio transcription failed: No transcription result")
-                    
-                logger.info("Audio transcription completed")
-                break  # Successfully completed, exit retry loop
+            if not any(transcriptions):
+                raise Exception("Audio transcription failed: No transcription result")
                 
-            except TimeoutError as te:
-                logger.error(f"Transcription timeout error: {str(te)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = 5 * retry_count  # Exponential backoff
-                    logger.info(f"Waiting {wait_time} seconds before retry {retry_count + 1}...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error("Maximum retry count reached, transcription failed")
-                    raise Exception("Audio transcription failed: Exceeded maximum retry count")
-            except Exception as e:
-                logger.error(f"Error during transcription process: {str(e)}")
-                raise
-            finally:
-                timer.cancel()
-                if timeout_occurred:
-                    logger.warning(f"Transcription attempt {retry_count + 1} was forcibly terminated")
+            logger.info("Audio transcription completed")
+            break  # Successfully completed, exit retry loop
+            
+        except concurrent.futures.TimeoutError:
+            logger.error(f"Transcription timeout error: Transcription process timed out (exceeded {timeout:.0f} seconds)")
+            stop_whisper_pool()
+            logger.warning(f"Transcription attempt {retry_count + 1} was forcibly terminated")
+            retry_count += 1
+            if retry_count < max_retries:
+                wait_time = 5 * retry_count  # Exponential backoff
+                logger.info(f"Waiting {wait_time} seconds before retry {retry_count + 1}...")
+                if _shutdown.wait(wait_time):
+                    raise KeyboardInterrupt
+            else:
+                logger.error("Maximum retry count reached, transcription failed")
+                raise Exception("Audio transcription failed: Exceeded maximum retry count")
+        except concurrent.futures.BrokenExecutor as e:
+            logger.error(f"Whisper worker process died: {str(e)}")
+            stop_whisper_pool()
+            raise
+        except Exception as e:
+            logger.error(f"Error during transcription process: {str(e)}")
+            raise
 
-        if not transcription:
-            raise Exception("Audio transcription failed: All retries unsuccessful")
-        
-        # 4. Save transcription text
-        transcription_file = save_transcription(
-            transcription,
-            audio_file,
-            os.path.join(config.OUTPUT_CONFIG['base_dir'], config.OUTPUT_CONFIG['text_dir'])
-        )
-        logger.info(f"Transcription text saved: {transcription_file}")
-        
-        # 5. Generate image prompt
-        max_prompt_attempts = 3
-        prompt = None
-        
-        for attempt in range(max_prompt_attempts):
-            try:
-                # Combine story background and transcription text
-                content = f"{config.STORY_BACKGROUND}\n\n{transcription}"
-                prompt = generate_prompt(content, config.PROMPT_TEMPLATE, config.LM_STUDIO_CONFIG)
-                break
-            except Exception as e:
-                logger.error(f"Failed to generate prompt (Attempt {attempt + 1}/{max_prompt_attempts}): {str(e)}")
-                if attempt < max_prompt_attempts - 1:
-                    wait_time = 5 * (attempt + 1)  # Exponential backoff
-                    logger.info(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                    # Reset LM Studio instance
-                    reset_lm_studio_instance()
-                else:
-                    raise Exception("Unable to generate prompt, maximum retry count reached")
-        
-        if not prompt:
-            raise Exception("Unable to generate prompt")
-        
-        # 6. Save prompt
-        prompt_file = save_prompt(
-            prompt,
-            os.path.join(config.OUTPUT_CONFIG['base_dir'], config.OUTPUT_CONFIG['text_dir'])
-        )
-        logger.info(f"Prompt saved: {prompt_file}")
-        
-        # 7. Generate image
-        comfy = ComfyUI(config.COMFYUI_CONFIG)
+    if not transcriptions:
+        raise Exception("Audio transcription failed: All retries unsuccessful")
+    
+    return transcriptions
+
+def generate_image_prompt(transcription):
+    """Generate and save an image prompt from a transcription"""
+    # 5. Generate image prompt
+    max_prompt_attempts = 3
+    prompt = None
+    
+    for attempt in range(max_prompt_attempts):
+        try:
+            # Combine story background and transcription text
+            content = f"{config.STORY_BACKGROUND}\n\n{transcription}"
+            prompt = generate_prompt(content, config.PROMPT_TEMPLATE, config.LM_STUDIO_CONFIG, stop_event=_shutdown)
+            break
+        except InterruptedError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to generate prompt (Attempt {attempt + 1}/{max_prompt_attempts}): {str(e)}")
+            if attempt < max_prompt_attempts - 1:
+                wait_time = 5 * (attempt + 1)  # Exponential backoff
+                logger.info(f"Waiting {wait_time} seconds before retry...")
+                if _shutdown.wait(wait_time):
+                    raise KeyboardInterrupt
+                # Reset LM Studio instance
+                reset_lm_studio_instance()
+            else:
+                raise Exception("Unable to generate prompt, maximum retry count reached")
+    
+    if not prompt:
+        raise Exception("Unable to generate prompt")
+    
+    # 6. Save prompt
+    # Written in the background; the file name is known up front
+    _, prompt_file = save_prompt(
+        prompt,
+        PATHS.text
+    )
+    return prompt, prompt_file
+
+def generate_image(prompt):
+    """Generate an image from a prompt with ComfyUI"""
+    # 7. Generate image
+    global _comfy_client
+    comfy = get_comfy()
+    try:
         image_path = comfy.generate_image(
             config.COMFYUI_CONFIG['workflow_path'],
             prompt,
-            os.path.join(config.OUTPUT_CONFIG['base_dir'], config.OUTPUT_CONFIG['image_dir']),
-            config.COMFYUI_CONFIG
+            PATHS.image,
+            config.COMFYUI_CONFIG,
+            stop_event=_shutdown
         )
-        
-        if image_path:
-            logger.info(f"Image generated successfully: {image_path}")
-            return {
-                'audio_file': audio_file,
-                'transcription_file': transcription_file,
-                'prompt_file': prompt_file,
-                'image_file': image_path
-            }
-        else:
-            raise Exception("Image generation failed")
-            
-    except Exception as e:
-        logger.error(f"Error during processing: {str(e)}")
+    except Exception:
+        # Drop the client's connections and rebuild it on the next call
+        comfy.close()
+        _comfy_client = None
         raise
+    
+    if image_path:
+        logger.info(f"Image generated successfully: {image_path}")
+        return image_path
+    else:
+        raise Exception("Image generation failed")
 
-def audio_recording_worker(task_queue):
+def audio_recording_worker(task_queue, devices=None):
     """Audio recording worker thread"""
-    while True:
+    while not _shutdown.is_set():
         try:
             # 1. Monitor audio
             logger.info("Starting audio monitoring...")
-            recording, sample_rate = monitor_audio(config.AUDIO_CONFIG)
+            recording, sample_rate = monitor_audio(config.AUDIO_CONFIG, devices, stop_event=_shutdown)
+            devices = None  # The startup device list is only needed for the first device scan
+            if _shutdown.is_set():
+                break
+            
+            # Skip silent recordings entirely (no file, no transcription)
+            rms = audio_rms(recording)
+            if rms < config.AUDIO_CONFIG.get('silence_rms', 0.005):
+                logger.info(f"Recording is silent (RMS: {rms:.4f}), skipping")
+                continue
             
-            # 2. Save audio file
-            audio_file = save_audio(
+            # 2. Save audio file (written in the background)
+            save_future, audio_file = save_audio(
                 recording, 
                 sample_rate, 
-                os.path.join(config.OUTPUT_CONFIG['base_dir'], config.OUTPUT_CONFIG['audio_dir'])
+                PATHS.audio
             )
-            logger.info(f"Audio saved: {audio_file}")
+            logger.info(f"Audio queued for saving: {audio_file}")
             
-            # Add task to queue
-            task_queue.put(audio_file)
+            # Add task to queue, dropping the oldest recording if the consumer is lagging
+            # for 60 seconds; wait in short slices so shutdown is noticed promptly
+            deadline = time.monotonic() + 60
+            while not _shutdown.is_set():
+                try:
+                    task_queue.put((save_future, audio_file), timeout=1)
+                    break
+                except Full:
+                    if time.monotonic() < deadline:
+                        continue
+                    logger.warning("Transcription is lagging behind recording, dropping oldest recording")
+                    try:
+                        task_queue.get_nowait()
+                        task_queue.task_done()
+                    except Empty:
+                        pass
             
         except Exception as e:
             logger.error(f"Error during recording process: {str(e)}")
-            time.sleep(1)  # Brief wait before continuing
+            _shutdown.wait(1)  # Brief wait before continuing
 
-def image_generation_worker(task_queue):
-    """Image generation worker thread"""
+def transcribe_worker(in_queue, out_queue):
+    """Transcription stage worker thread"""
+    max_batch = config.WHISPER_CONFIG.get('max_batch', 4)
+    stop = False
+    try:
+        while not stop:
+            tasks = []
+            try:
+                # Get task from queue, then drain up to max_batch pending tasks
+                task = in_queue.get()
+                if task is None:
+                    in_queue.task_done()
+                    break
+                tasks.append(task)
+                while len(tasks) < max_batch:
+                    try:
+                        task = in_queue.get_nowait()
+                    except Empty:
+                        break
+                    if task is None:
+                        in_queue.task_done()
+                        stop = True
+                        break
+                    tasks.append(task)
+            
+                # After Ctrl+C, skip queued work and only pass the end marker on
+                if _shutdown.is_set():
+                    continue
+                
+                # Wait for the audio files to be written to disk
+                audio_files = []
+                for save_future, audio_file in tasks:
+                    save_future.result()
+                    audio_files.append(audio_file)
+            
+                # Transcribe the whole batch at once
+                transcriptions = transcribe_audio_files(audio_files)
+            
+                for audio_file, transcription in zip(audio_files, transcriptions):
+                    if not transcription:
+                        logger.error(f"Audio transcription failed for {audio_file}: No transcription result")
+                        continue
+                
+                    # 4. Save transcription text
+                    # Written in the background; the file name is known up front
+                    _, transcription_file = save_transcription(
+                        transcription,
+                        audio_file,
+                        PATHS.text
+                    )
+                
+                    out_queue.put({
+                        'audio_file': audio_file,
+                        'transcription': transcription,
+                        'transcription_file': transcription_file
+                    })
+            
+            except KeyboardInterrupt:
+                # Retry backoff cancelled by shutdown, keep draining until the end marker
+                logger.info("Transcription cancelled by shutdown")
+            except Exception as e:
+                logger.error(f"Error during transcription stage: {str(e)}")
+            finally:
+                for _ in tasks:
+                    in_queue.task_done()
+    finally:
+        # Propagate end marker to the next stage
+        out_queue.put(None)
+
+def prompt_worker(in_queue, out_queue):
+    """Prompt generation stage worker thread"""
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                in_queue.task_done()
+                break
+            if _shutdown.is_set():
+                # After Ctrl+C, skip queued work and only pass the end marker on
+                in_queue.task_done()
+                continue
+        
+            try:
+                item['prompt'], item['prompt_file'] = generate_image_prompt(item['transcription'])
+                out_queue.put(item)
+            except (KeyboardInterrupt, InterruptedError):
+                # Request or retry backoff cancelled by shutdown, keep draining until the end marker
+                logger.info(f"Prompt generation cancelled by shutdown for {item['audio_file']}")
+            except Exception as e:
+                logger.error(f"Error during prompt generation stage for {item['audio_file']}: {str(e)}")
+            finally:
+                in_queue.task_done()
+    finally:
+        # Propagate end marker to the next stage
+        out_queue.put(None)
+
+def comfy_worker(in_queue):
+    """Image generation stage worker thread"""
     while True:
+        item = in_queue.get()
+        if item is None:
+            in_queue.task_done()
+            break
+        if _shutdown.is_set():
+            # After Ctrl+C, skip queued work until the end marker
+            in_queue.task_done()
+            continue
+        
         try:
-            # Get task from queue
-            audio_file = task_queue.get()
-            if audio_file is None:
-                break
-                
-            # Process audio to image conversion
-            results = process_audio_to_image(audio_file)
+            image_file = generate_image(item['prompt'])
             
             # Output result summary
             logger.info("\n=== Processing Complete ===")
-            logger.info(f"Audio file: {results['audio_file']}")
-            logger.info(f"Transcription text: {results['transcription_file']}")
-            logger.info(f"Prompt file: {results['prompt_file']}")
-            logger.info(f"Generated image: {results['image_file']}")
-            
-            task_queue.task_done()
-            
+            logger.info(f"Audio file: {item['audio_file']}")
+            logger.info(f"Transcription text: {item['transcription_file']}")
+            logger.info(f"Prompt file: {item['prompt_file']}")
+            logger.info(f"Generated image: {image_file}")
+        except InterruptedError:
+            logger.info(f"Image generation cancelled by shutdown for {item['audio_file']}")
         except Exception as e:
-            logger.error(f"Error during image generation process: {str(e)}")
-            task_queue.task_done()
+            logger.error(f"Error during image generation stage for {item['audio_file']}: {str(e)}")
+        finally:
+            in_queue.task_done()
+
+def _handle_sigint(signum, frame):
+    """Request a clean shutdown; a second Ctrl+C kills the process"""
+    _shutdown.set()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
 
 def main():
     """Main program entry point"""
+    # Ctrl+C only sets the shutdown event so every worker can stop cleanly
+    signal.signal(signal.SIGINT, _handle_sigint)
     try:
         # Display all audio input devices
-        list_audio_devices()
+        devices = list_audio_devices()
         logger.info("=== End of Device List ===\n")
         
         # Set up directories
         setup_directories()
         
+        # Load (and warm up) the Whisper model before recording starts, outside any
+        # transcription timeout
+        get_whisper_pool()
+        
         logger.info("Program started, beginning parallel processing of audio to image conversion...")
         logger.info("Press Ctrl+C to stop the program")
         
-        # Create task queue
-        task_queue = Queue()
+        # Create task queue and bounded queues between pipeline stages
+        task_queue = Queue(maxsize=config.AUDIO_CONFIG.get('queue_size', 4))
+        prompt_queue = Queue(maxsize=2)
+        image_queue = Queue(maxsize=2)
         
         # Create and start worker threads
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
             # Start audio recording thread
-            audio_future = executor.submit(audio_recording_worker, task_queue)
+            audio_future = executor.submit(audio_recording_worker, task_queue, devices)
             
-            # Start image generation thread
-            image_future = executor.submit(image_generation_worker, task_queue)
+            # Start transcription, prompt generation and image generation stages
+            stage_futures = [
+                executor.submit(transcribe_worker, task_queue, prompt_queue),
+                executor.submit(prompt_worker, prompt_queue, image_queue),
+                executor.submit(comfy_worker, image_queue)
+            ]
             
-            try:
-                # Wait for threads to complete
-                audio_future.result()
-                image_future.result()
-            except KeyboardInterrupt:
-                logger.info("\nUser interrupted program execution")
-                # Clear queue and add end marker
-                while not task_queue.empty():
-                    task_queue.get()
-                task_queue.put(None)
-                return
+            # Wait until Ctrl+C sets the shutdown event
+            while not _shutdown.wait(1):
+                pass
+            logger.info("\nUser interrupted program execution")
+            
+            # Wait for the recording thread to stop, then clear queue and add end marker
+            audio_future.result()
+            while True:
+                try:
+                    task_queue.get_nowait()
+                except Empty:
+                    break
+            task_queue.put(None)
+            for future in stage_futures:
+                future.result()
+            # Don't wait for a transcription still running in the worker process
+            stop_whisper_pool()
+            return
             
     except Exception as e:
         logger.error(f"Program execution failed: {str(e)}")
         logger.info("Program will automatically restart in 5 seconds...")
-        time.sleep(5)
+        if _shutdown.wait(5):
+            return
         main()  # Restart main program
 
 if __name__ == "__main__":
+    # Only in the main process: spawned workers import this module too
+    setup_logging()
     try:
         main()
     except KeyboardInterrupt:
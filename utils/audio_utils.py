@@ -2,13 +2,22 @@ import sounddevice as sd
 import numpy as np
 import wave
 import os
-from datetime import datetime
-import queue
+from utils.file_utils import make_timestamp, ensure_dir
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['monitor_audio', 'save_audio', 'get_device_info', 'find_stereo_mix_device', 'list_audio_devices']
+# Single background thread for WAV writes, so the next recording can start immediately
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio_io')
+
+# Selected input device, cached across recordings until the device fails to open
+_device_cache = {}
+
+# Scratch buffer reused across save_audio calls for the float32 -> int16 conversion
+_scratch = None
+
+__all__ = ['monitor_audio', 'save_audio', 'audio_rms', 'get_device_info', 'find_stereo_mix_device', 'wav_duration', 'list_audio_devices']
 
 def get_device_info(device_id):
     """Get audio device information"""
@@ -20,9 +29,10 @@ def get_device_info(device_id):
         logger.error(f"Error getting device info: {str(e)}")
         return None
 
-def find_stereo_mix_device():
-    """Find stereo mix device"""
-    devices = sd.query_devices()
+def find_stereo_mix_device(devices=None):
+    """Find stereo mix device (optionally from a pre-fetched device list)"""
+    if devices is None:
+        devices = sd.query_devices()
     for i, device in enumerate(devices):
         # Check if device name contains keywords
         if any(keyword in device['name'].lower() for keyword in ['stereo mix', '立體聲混音', 'what u hear', 'what you hear']) and device['max_input_channels'] > 0:
@@ -35,13 +45,14 @@ def find_stereo_mix_device():
                 continue
     return None
 
-def monitor_audio(config):
-    """Monitor audio output"""
+def _select_device(devices=None):
+    """Select the input device and cache it in _device_cache"""
     # Get all devices
-    devices = sd.query_devices()
+    if devices is None:
+        devices = sd.query_devices()
     
     # First try to find stereo mix device
-    stereo_mix_id = find_stereo_mix_device()
+    stereo_mix_id = find_stereo_mix_device(devices)
     
     if stereo_mix_id is None:
         # If stereo mix is not found, display all input devices for selection
@@ -83,88 +94,166 @@ def monitor_audio(config):
 
     # Use device's default sample rate
     sample_rate = int(device_info['default_samplerate'])
+
+    _device_cache.update({'device_id': device_id, 'sample_rate': sample_rate, 'info': device_info})
+
+def _clear_device_cache():
+    """Forget the selected device so the next recording rescans devices"""
+    _device_cache.clear()
+
+def _record(config, stop_event=None):
+    """Record audio from the cached device"""
+    device_id = _device_cache['device_id']
+    device_info = _device_cache['info']
+    sample_rate = _device_cache['sample_rate']
     channels = config['channels']
     duration = config['duration']
 
     logger.info(f"Starting audio monitoring for {duration} seconds... Using device: ID:{device_id} {device_info['name']} (Sample rate: {sample_rate}Hz, Channels: {channels})")
 
-    # Create queue to store audio data
-    q = queue.Queue()
-    recording = []
+    # Preallocate a single buffer for the whole recording (plus one second of headroom)
+    # Samples are captured as int16 so they can be written to the WAV file without conversion
+    buffer = np.empty((int(duration * sample_rate) + sample_rate, channels), dtype=np.int16)
+    write_idx = [0]
 
     def audio_callback(indata, frames, time, status):
         """Audio callback function"""
         if status:
             logger.warning(f"Status: {status}")
-        q.put(indata.copy())
+        start = write_idx[0]
+        end = min(start + frames, len(buffer))
+        # Slice assignment copies indata into our buffer, so no .copy() is needed
+        buffer[start:end] = indata[:end - start]
+        write_idx[0] = end
 
-    try:
-        # Verify device settings
-        sd.check_input_settings(
-            device=device_id,
-            channels=channels,
-            samplerate=sample_rate
-        )
-        
-        # Create input stream
-        with sd.InputStream(
-            device=device_id,
-            channels=channels,
-            samplerate=sample_rate,
-            callback=audio_callback
-        ):
-            logger.info("Starting monitoring...")
-            # Wait for specified duration
+    # Verify device settings
+    sd.check_input_settings(
+        device=device_id,
+        channels=channels,
+        dtype='int16',
+        samplerate=sample_rate
+    )
+    
+    # Create input stream
+    with sd.InputStream(
+        device=device_id,
+        channels=channels,
+        samplerate=sample_rate,
+        dtype='int16',
+        callback=audio_callback
+    ):
+        logger.info("Starting monitoring...")
+        # Wait for specified duration (or until stop_event is set)
+        if stop_event is not None:
+            stop_event.wait(duration)
+        else:
             sd.sleep(int(duration * 1000))
-            logger.info("Monitoring complete!")
+        logger.info("Monitoring complete!")
 
-        # Get all data from queue
-        while not q.empty():
-            recording.append(q.get())
+    if write_idx[0] > 0:
+        return buffer[:write_idx[0]], sample_rate
+    else:
+        raise Exception("No audio data captured")
 
-        # Convert data to numpy array
-        if recording:
-            recording = np.concatenate(recording, axis=0)
-            return recording, sample_rate
-        else:
-            raise Exception("No audio data captured")
+def monitor_audio(config, devices=None, stop_event=None):
+    """Monitor audio output
 
-    except Exception as e:
-        raise Exception(f"Error monitoring audio: {str(e)}")
+    devices is an optional pre-fetched sd.query_devices() list used for the first device scan.
+    If stop_event (a threading.Event) is set, recording stops early.
+    """
+    for attempt in range(2):
+        if not _device_cache:
+            _select_device(devices)
+        try:
+            return _record(config, stop_event)
+        except sd.PortAudioError as e:
+            # Device may have disappeared or changed, rescan and retry once
+            _clear_device_cache()
+            devices = None  # The device list may be stale, query it again
+            if attempt == 0:
+                logger.warning(f"Error opening audio device, rescanning devices: {str(e)}")
+                continue
+            raise Exception(f"Error monitoring audio: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error monitoring audio: {str(e)}")
 
-def save_audio(recording, sample_rate, output_dir):
-    """Save audio as WAV file"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = os.path.join(output_dir, f"recording_{timestamp}.wav")
-    
-    # Convert float32 to int16
-    audio_data = (recording * 32767).astype(np.int16)
-    
+def audio_rms(recording):
+    """Get the RMS level of a recording, normalized to full scale (0.0-1.0)"""
+    if recording.size == 0:
+        return 0.0
+    samples = recording.astype(np.float32).ravel()
+    rms = float(np.sqrt(np.dot(samples, samples) / samples.size))
+    if recording.dtype == np.int16:
+        rms /= 32768.0
+    return rms
+
+def _to_int16(recording):
+    """Convert float32 samples to int16 with saturation, reusing the scratch buffer"""
+    global _scratch
+    if _scratch is None or _scratch.size < recording.size:
+        _scratch = np.empty(recording.size, dtype=np.float32)
+    scratch = _scratch[:recording.size].reshape(recording.shape)
+    np.multiply(recording, 32767.0, out=scratch)
+    np.clip(scratch, -32768.0, 32767.0, out=scratch)
+    return scratch.astype(np.int16, copy=False)
+
+def _write_wav(filename, audio_data, channels, sample_rate):
+    """Write int16 PCM data to a WAV file"""
     try:
         with wave.open(filename, 'wb') as wf:
             # Set WAV file parameters
             wf.setparams((
-                recording.shape[1] if len(recording.shape) > 1 else 1,  # Number of channels
+                channels,  # Number of channels
                 2,  # Sample width (bytes)
                 sample_rate,  # Sample rate
                 len(audio_data),  # Number of frames
                 'NONE',  # Compression type
                 'NONE'  # Compression name
             ))
-            # Write audio data
-            wf.writeframes(audio_data.tobytes())
+            # Write audio data straight from the array buffer (no tobytes() copy);
+            # the header already holds the frame count so no rewrite is needed
+            wf.writeframesraw(np.ascontiguousarray(audio_data).data)
         
         logger.info(f"Audio saved to: {filename}")
         return filename
     except Exception as e:
         raise Exception(f"Error saving audio file: {str(e)}")
 
-def list_audio_devices():
-    """List all available audio devices"""
+def save_audio(recording, sample_rate, output_dir):
+    """Save audio as WAV file in the background
+
+    Returns a (future, filename) tuple; call future.result() before reading the file.
+    """
+    timestamp = make_timestamp()
+    ensure_dir(output_dir)
+    
+    filename = os.path.join(output_dir, f"recording_{timestamp}.wav")
+    
+    if recording.dtype == np.int16:
+        audio_data = recording
+    else:
+        # Convert float32 to int16 (clipped to avoid wraparound)
+        audio_data = _to_int16(recording)
+    channels = recording.shape[1] if len(recording.shape) > 1 else 1
+    
+    future = _io_pool.submit(_write_wav, filename, audio_data, channels, sample_rate)
+    return future, filename
+
+def wav_duration(filename):
+    """Get the duration of a WAV file in seconds from its header (0.0 if unreadable)"""
+    try:
+        with wave.open(filename, 'rb') as wf:
+            return wf.getnframes() / wf.getframerate()
+    except Exception as e:
+        logger.warning(f"Unable to read duration of {filename}: {e}")
+        return 0.0
+
+def list_audio_devices(devices=None):
+    """List all available audio devices and return the device list"""
     logger.info("Available audio devices:")
-    devices = sd.query_devices()
+    if devices is None:
+        devices = sd.query_devices()
     for i, device in enumerate(devices):
         if device['max_input_channels'] > 0:  # Only show devices with input channels
-            logger.info(f"Device {i}: {device['name']}") 
\ No newline at end of file
+            logger.info(f"Device {i}: {device['name']}") 
+    return devices
@@ -1,104 +1,244 @@
 import json
 import os
+import copy
+import functools
 import time
-import websocket
-import urllib.request
-import urllib.parse
+import socket
+import sys
+import shutil
+import selectors
+import concurrent.futures
+import urllib3
 import logging
-from datetime import datetime
+from utils.file_utils import make_timestamp, ensure_dir
+from pathlib import Path
+
+# orjson is considerably faster than the standard library; fall back if unavailable
+try:
+    from orjson import loads as _json_loads, dumps as _json_dumps
+except ImportError:
+    from json import loads as _json_loads
+
+    def _json_dumps(obj):
+        """Serialize obj to UTF-8 JSON bytes"""
+        return json.dumps(obj).encode('utf-8')
 
 logger = logging.getLogger(__name__)
 
+# Minimum interval between progress line updates (seconds)
+_PROGRESS_INTERVAL = 0.05
+
+# Progress lines are only written to an interactive terminal
+_tty = sys.stdout.isatty()
+
+# Raw "type" markers of the WebSocket messages track_progress acts on (with and without a space after the colon)
+_TRACKED_MESSAGE_MARKERS = tuple(
+    (message_type, (f'"type": "{message_type}"', f'"type":"{message_type}"'))
+    for message_type in ('progress', 'execution_cached', 'executing')
+)
+
+def _message_type(raw):
+    """Get the type of a raw WebSocket message if track_progress handles it, without parsing the JSON"""
+    for message_type, markers in _TRACKED_MESSAGE_MARKERS:
+        if markers[0] in raw or markers[1] in raw:
+            return message_type
+    return None
+
 class ComfyUI:
     def __init__(self, config):
         """Initialize ComfyUI connection"""
         self.server_address = config['server_address']
         self.client_id = config['client_id']
         self.ws = None
-        logger.info(f"Connecting to ComfyUI server: {self.server_address}")
+        # WebSocket receive timeout, and how long to wait without any message before giving up (seconds)
+        self.recv_timeout = config.get('recv_timeout', 30)
+        self.max_idle = config.get('max_idle', 300)
+        # Persistent HTTP connection pool, reused by all requests to the server
+        self._http = urllib3.PoolManager(num_pools=1, maxsize=4)
+        # Request URLs and headers are built once per client
+        self._prompt_url = f"http://{self.server_address}/prompt"
+        self._history_url = f"http://{self.server_address}/history/"
+        self._view_url = f"http://{self.server_address}/view"
+        self._json_headers = {'Content-Type': 'application/json'}
+        logger.info("Connecting to ComfyUI server: %s", self.server_address)
 
     def open_websocket_connection(self):
         """Establish WebSocket connection"""
-        self.ws = websocket.WebSocket()
+        import websocket  # Imported on first use to keep module import light
+        # Progress frames are JSON from a trusted local server, so skip per-frame UTF-8
+        # validation; use a larger receive buffer and disable Nagle for small frames
+        self.ws = websocket.WebSocket(
+            enable_multithread=False,
+            skip_utf8_validation=True,
+            sockopt=(
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20),
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            )
+        )
         self.ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+        self.ws.settimeout(self.recv_timeout)
         return self.ws
 
+    def close(self):
+        """Close the WebSocket and all pooled HTTP connections"""
+        if self.ws:
+            self.ws.close()
+        self._http.clear()
+
+    def _request(self, method, url, **kwargs):
+        """Send an HTTP request over the connection pool and return the response body"""
+        response = self._http.request(method, url, **kwargs)
+        if response.status >= 400:
+            raise Exception(f"ComfyUI request failed: HTTP {response.status} for {url}")
+        return response.data
+
     def queue_prompt(self, prompt):
         """Send prompt to ComfyUI workflow"""
-        p = {"prompt": prompt, "client_id": self.client_id}
-        headers = {'Content-Type': 'application/json'}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request(
-            f"http://{self.server_address}/prompt",
-            data=data,
-            headers=headers
-        )
-        return json.loads(urllib.request.urlopen(req).read())
+        body = _json_dumps({"prompt": prompt, "client_id": self.client_id})
+        return _json_loads(self._request('POST', self._prompt_url, body=body, headers=self._json_headers))
 
     def get_history(self, prompt_id):
         """Get history for specified prompt ID"""
-        with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+        return _json_loads(self._request('GET', self._history_url + prompt_id))
 
     def get_image(self, filename, subfolder, folder_type):
         """Get image from ComfyUI"""
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"http://{self.server_address}/view?{url_values}") as response:
-            return response.read()
-
-    def track_progress(self, prompt, prompt_id):
-        """Track generation progress"""
-        node_ids = list(prompt.keys())
-        finished_nodes = []
+        return self._request('GET', self._view_url, fields=data)
+
+    def get_image_to(self, filename, subfolder, folder_type, out_fp):
+        """Stream image from ComfyUI into an open binary file"""
+        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        response = self._http.request('GET', self._view_url, fields=data, preload_content=False)
+        try:
+            if response.status >= 400:
+                raise Exception(f"ComfyUI request failed: HTTP {response.status} for {self._view_url}")
+            shutil.copyfileobj(response, out_fp, length=1 << 20)
+        finally:
+            response.release_conn()
+
+    def _download_one(self, image, output_path):
+        """Download one output image to output_path"""
+        # Stream image straight into the output file; the file is unbuffered
+        # so each 1 MiB chunk goes directly to a write() syscall
+        try:
+            with open(output_path, 'wb', buffering=0) as f:
+                self.get_image_to(
+                    image['filename'],
+                    image['subfolder'],
+                    image['type'],
+                    f
+                )
+        except Exception:
+            # Don't leave a partial image behind
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        logger.info('Image saved to: %s', output_path)
+
+    def track_progress(self, prompt, prompt_id, stop_event=None):
+        """Track generation progress
+
+        If stop_event is set while waiting, raises InterruptedError.
+        """
+        import websocket
+        if stop_event is not None:
+            # Receive in short slices so the stop event is noticed promptly
+            self.ws.settimeout(min(self.recv_timeout, 1))
+        total_nodes = len(prompt)
+        finished_nodes = set()
         last_progress = 0
+        last_print = 0.0
+        last_text = ''
+        pending_text = None
+
+        def show_progress(text):
+            """Overwrite the progress line, at most once per _PROGRESS_INTERVAL"""
+            nonlocal last_print, last_text
+            last_text = text
+            now = time.monotonic()
+            if now - last_print > _PROGRESS_INTERVAL:
+                sys.stdout.write(text + '\r')
+                sys.stdout.flush()
+                last_print = now
+
+        # Used to check whether more frames are already waiting, so a burst of
+        # messages is drained before the progress line is updated once
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.ws.sock, selectors.EVENT_READ)
 
-        while True:
-            out = self.ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message['type'] == 'progress':
+            last_message = time.monotonic()
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    raise InterruptedError("Image generation cancelled")
+                if pending_text is not None and not selector.select(timeout=0):
+                    show_progress(pending_text)
+                    pending_text = None
+                try:
+                    out = self.ws.recv()
+                except (websocket.WebSocketTimeoutException, socket.timeout):
+                    if time.monotonic() - last_message > self.max_idle:
+                        raise TimeoutError(f"No message from ComfyUI for {self.max_idle} seconds")
+                    continue
+                last_message = time.monotonic()
+                if not isinstance(out, str):
+                    continue
+                # Only parse the messages we act on
+                if _message_type(out) is None:
+                    continue
+                message = _json_loads(out)
+                message_type = message['type']
+                if message_type == 'progress':
                     data = message['data']
                     current_step = data['value']
-                    print(f'K-Sampler progress -> Step: {current_step}/{data["max"]}', end='\r', flush=True)
-                if message['type'] == 'execution_cached':
+                    if _tty:
+                        pending_text = f'K-Sampler progress -> Step: {current_step}/{data["max"]}'
+                if message_type == 'execution_cached':
                     data = message['data']
                     for itm in data['nodes']:
                         if itm not in finished_nodes:
-                            finished_nodes.append(itm)
+                            finished_nodes.add(itm)
                             progress = len(finished_nodes)
                             if progress != last_progress:
-                                print(f'Progress: {progress}/{len(node_ids)} tasks completed', end='\r', flush=True)
+                                if _tty:
+                                    pending_text = f'Progress: {progress}/{total_nodes} tasks completed'
                                 last_progress = progress
-                if message['type'] == 'executing':
+                if message_type == 'executing':
                     data = message['data']
                     if data['node'] not in finished_nodes:
-                        finished_nodes.append(data['node'])
+                        finished_nodes.add(data['node'])
                         progress = len(finished_nodes)
                         if progress != last_progress:
-                            print(f'Progress: {progress}/{len(node_ids)} tasks completed', end='\r', flush=True)
+                            if _tty:
+                                pending_text = f'Progress: {progress}/{total_nodes} tasks completed'
                             last_progress = progress
                     if data['node'] is None and data['prompt_id'] == prompt_id:
-                        print()  # New line
+                        # Always finish the progress line, even if the last update was throttled
+                        if _tty:
+                            sys.stdout.write((pending_text or last_text) + '\n')
+                            sys.stdout.flush()
                         break
-            else:
-                continue
 
-    def generate_image(self, workflow_path, prompt_text, output_dir, config):
-        """Main function for image generation"""
+    def generate_image(self, workflow_path, prompt_text, output_dir, config, stop_event=None):
+        """Main function for image generation
+
+        Setting stop_event stops waiting for the result (raises InterruptedError).
+        """
         try:
             # Read workflow
-            with open(workflow_path, 'r', encoding='utf-8') as f:
-                workflow = json.load(f)
+            workflow = load_workflow_template(workflow_path)
+            if workflow is None:
+                raise Exception(f"Unable to load workflow template: {workflow_path}")
 
             # Update prompt text
-            for node_id, node in workflow.items():
-                if node.get('class_type') == 'CLIPTextEncode' and node.get('_meta', {}).get('title') == 'CLIP Text Encode (Positive Prompt)':
-                    node['inputs']['text'] = prompt_text
-                    break
+            node_id = _positive_prompt_node_id(workflow_path)
+            if node_id is not None:
+                workflow[node_id]['inputs']['text'] = prompt_text
+            else:
+                logger.warning("No positive prompt node found in workflow: %s", workflow_path)
 
             # Create output directory
-            os.makedirs(output_dir, exist_ok=True)
+            ensure_dir(output_dir)
 
             # Establish WebSocket connection
             self.open_websocket_connection()
@@ -107,40 +247,66 @@ class ComfyUI:
             prompt_id = self.queue_prompt(workflow)['prompt_id']
 
             # Track progress
-            self.track_progress(workflow, prompt_id)
+            self.track_progress(workflow, prompt_id, stop_event)
 
-            # Get generated image
+            # Get generated images
             history = self.get_history(prompt_id)[prompt_id]
-            for node_id in history['outputs']:
-                node_output = history['outputs'][node_id]
-                if 'images' in node_output:
-                    for image in node_output['images']:
-                        if image['type'] == 'output':
-                            image_data = self.get_image(
-                                image['filename'],
-                                image['subfolder'],
-                                image['type']
-                            )
-                            
-                            # Use timestamp as filename
-                            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                            output_path = os.path.join(output_dir, f'comfyui_{timestamp}.png')
-                            
-                            # Save image
-                            with open(output_path, 'wb') as f:
-                                f.write(image_data)
-                            logger.info(f'Image saved to: {output_path}')
-                            return output_path
+            images = [
+                image
+                for node_output in history['outputs'].values()
+                for image in node_output.get('images', [])
+                if image['type'] == 'output'
+            ]
+            if not images:
+                return None
+
+            # Use timestamp as filename (numbered when the workflow outputs several images)
+            timestamp = make_timestamp()
+            if len(images) == 1:
+                output_paths = [os.path.join(output_dir, f'comfyui_{timestamp}.png')]
+            else:
+                output_paths = [os.path.join(output_dir, f'comfyui_{timestamp}_{i}.png') for i in range(len(images))]
+
+            # Download several images in parallel over the pooled connections
+            if len(images) == 1:
+                self._download_one(images[0], output_paths[0])
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(images))) as executor:
+                    list(executor.map(self._download_one, images, output_paths))
+            return output_paths[0]
 
         finally:
             if self.ws:
                 self.ws.close()
 
+def _find_positive_prompt_node(workflow):
+    """Find the ID of the positive prompt CLIPTextEncode node"""
+    for node_id, node in workflow.items():
+        if node.get('class_type') == 'CLIPTextEncode' and node.get('_meta', {}).get('title') == 'CLIP Text Encode (Positive Prompt)':
+            return node_id
+    return None
+
+@functools.lru_cache(maxsize=32)
+def _load_workflow_cached(workflow_path, mtime):
+    """Read and parse a workflow file (cached until the file is modified)
+
+    Returns (workflow, positive_prompt_node_id).
+    """
+    workflow = _json_loads(Path(workflow_path).read_bytes())
+    return workflow, _find_positive_prompt_node(workflow)
+
+def _positive_prompt_node_id(workflow_path):
+    """Get the cached positive prompt node ID for a workflow file"""
+    return _load_workflow_cached(workflow_path, os.path.getmtime(workflow_path))[1]
+
 def load_workflow_template(workflow_path):
-    """Load workflow template"""
+    """Load workflow template
+
+    Returns a copy of the cached template, so callers may modify it freely.
+    """
     try:
-        with open(workflow_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        workflow, _ = _load_workflow_cached(workflow_path, os.path.getmtime(workflow_path))
+        return copy.deepcopy(workflow)
     except Exception as e:
-        logger.error(f"Error loading workflow template: {e}")
+        logger.error("Error loading workflow template: %s", e)
         return None 
\ No newline at end of file
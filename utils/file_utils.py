@@ -0,0 +1,44 @@
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['make_timestamp', 'ensure_dir', 'write_text_atomic', 'write_text_async']
+
+# Directories already created by this process
+_created_dirs = set()
+
+# Background writer for text files, so callers don't wait on disk I/O
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file_writer')
+
+def make_timestamp():
+    """Get a filename timestamp with a microsecond suffix, so files saved in the same second don't collide"""
+    t = time.time()
+    return time.strftime('%Y%m%d_%H%M%S', time.localtime(t)) + f"_{int((t % 1) * 1e6):06d}"
+
+def ensure_dir(directory):
+    """Create a directory once per process (skips the filesystem check on later calls)"""
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+
+def write_text_atomic(filename, text):
+    """Write a text file atomically (a crash mid-write never leaves a truncated file)"""
+    # Create the temporary file with mode 0o666 (less the umask) like open() does;
+    # NamedTemporaryFile would make it, and so the final file, owner-only
+    tmp_name = f"{filename}.{os.getpid()}_{threading.get_ident()}.tmp"
+    fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+def write_text_async(filename, text):
+    """Write a text file atomically on the background writer thread; returns a Future"""
+    return _writer.submit(write_text_atomic, filename, text)
@@ -1,155 +1,338 @@
-import lmstudio as lms
 import logging
 import time
 import os
-from datetime import datetime
+import threading
+import hashlib
+import string
+import functools
+import concurrent.futures
+from collections import OrderedDict
+from queue import Queue
+from utils.file_utils import make_timestamp, ensure_dir, write_text_async
 
 logger = logging.getLogger(__name__)
 
 # Global variable for storing LM Studio instance
 _lm_studio_instance = None
 _last_connection_time = None
-_connection_timeout = 300  # 5 minutes timeout
+_connection_timeout = 1800  # 30 minutes; keep warm connections across a session
+# Guards the instance globals; reentrant because get_lm_studio_instance resets while holding it
+_lm_studio_lock = threading.RLock()
+# Completion requests currently waited on (guarded by _lm_studio_lock); the shared
+# instance is not reset while other requests are using it
+_in_flight = 0
+
+# Long-lived worker threads that run completions so they can be waited on with a
+# timeout. They are daemon threads pulling (fn, future) jobs from a queue rather than
+# a ThreadPoolExecutor, whose workers are joined at interpreter exit: a request that
+# hangs even after being cancelled must not keep the process from exiting.
+_completion_queue = Queue()
+_completion_workers = 4
+# Live worker count and futures whose worker was given up on (guarded by _completion_lock)
+_completion_threads = 0
+_abandoned = set()
+_completion_lock = threading.Lock()
+# How long to wait for a cancelled completion to stop (seconds)
+_cancel_timeout = 5
+
+def _completion_worker():
+    """Run completion jobs until this worker's request is abandoned"""
+    while True:
+        fn, future = _completion_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        with _completion_lock:
+            if future in _abandoned:
+                # A replacement worker was started while this one was stuck
+                _abandoned.discard(future)
+                return
+
+def _submit_completion(fn):
+    """Queue fn for a completion worker and return a Future for its result"""
+    global _completion_threads
+    with _completion_lock:
+        while _completion_threads < _completion_workers:
+            threading.Thread(target=_completion_worker, name='lms', daemon=True).start()
+            _completion_threads += 1
+    future = concurrent.futures.Future()
+    _completion_queue.put((fn, future))
+    return future
+
+def _abandon_completion(future):
+    """Replace the worker still stuck on future's request after it was cancelled"""
+    global _completion_threads
+    with _completion_lock:
+        if future.done():
+            return  # It finished after all, and the worker carries on
+        _abandoned.add(future)
+        _completion_threads -= 1  # The next submit starts a replacement
+
+# LRU cache of generated prompts, keyed on (content hash, template, model name)
+_prompt_cache = OrderedDict()
+_prompt_cache_size = 128
+_prompt_cache_lock = threading.Lock()
+
+def _prompt_cache_key(content, prompt_template, config):
+    """Build the prompt cache key from whitespace-normalized content"""
+    normalized = " ".join(content.split())
+    content_hash = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+    return (content_hash, prompt_template, config['model_name'])
+
+@functools.lru_cache(maxsize=32)
+def _compile_template(prompt_template):
+    """Parse a str.format prompt template once into literal pieces around {content}
+
+    Returns the pieces to join with the content, or None if the template uses
+    other fields or format specs (rendered with str.format instead).
+    """
+    pieces = []
+    for literal, field, spec, conversion in string.Formatter().parse(prompt_template):
+        pieces.append(literal)
+        if field is None:
+            continue
+        if field != 'content' or spec or conversion:
+            return None
+        pieces.append(None)
+    return tuple(pieces)
+
+def _render_template(prompt_template, content):
+    """Fill {content} into a prompt template"""
+    pieces = _compile_template(prompt_template)
+    if pieces is None:
+        return prompt_template.format(content=content)
+    return "".join(content if piece is None else piece for piece in pieces)
+
+def clear_prompt_cache():
+    """Clear cached prompts"""
+    with _prompt_cache_lock:
+        _prompt_cache.clear()
 
 def reset_lm_studio_instance():
     """Reset LM Studio instance"""
     global _lm_studio_instance, _last_connection_time
     
-    try:
-        # If instance exists, try to close connection
-        if _lm_studio_instance is not None:
+    with _lm_studio_lock:
+        try:
+            # If instance exists, try to close connection
+            if _lm_studio_instance is not None:
+                try:
+                    # Try to close any open connections
+                    if hasattr(_lm_studio_instance, 'close'):
+                        _lm_studio_instance.close()
+                except Exception as e:
+                    logger.warning("Error closing LM Studio instance: %s", e)
+        finally:
+            # Reset instance regardless
+            _lm_studio_instance = None
+            _last_connection_time = None
+            
+            # Reset default client so it can be configured again
             try:
-                # Try to close any open connections
-                if hasattr(_lm_studio_instance, 'close'):
-                    _lm_studio_instance.close()
+                from lmstudio.sync_api import _reset_default_client
+                _reset_default_client()
             except Exception as e:
-                logger.warning(f"Error closing LM Studio instance: {str(e)}")
-    finally:
-        # Reset instance regardless
-        _lm_studio_instance = None
-        _last_connection_time = None
-        
-        # Reset default client
-        try:
-            from lmstudio.sync_api import _reset_default_client
-            _reset_default_client()
-        except Exception as e:
-            logger.warning(f"Error resetting LM Studio default client: {str(e)}")
-        
-        # Re-import module to reset client
-        try:
-            import importlib
-            importlib.reload(lms)
-        except Exception as e:
-            logger.warning(f"Error reinitializing LM Studio client: {str(e)}")
+                logger.warning("Error resetting LM Studio default client: %s", e)
 
-def get_lm_studio_instance(config):
-    """Get LM Studio instance (singleton pattern)"""
-    global _lm_studio_instance, _last_connection_time
-    
-    current_time = time.time()
-    
-    # Check if reconnection is needed
-    if (_lm_studio_instance is None or 
-        _last_connection_time is None or 
-        current_time - _last_connection_time > _connection_timeout):
-        
-        # Reset existing instance
+def _reset_if_idle():
+    """Reset the LM Studio instance unless other requests are still using it"""
+    with _lm_studio_lock:
+        if _in_flight:
+            logger.warning("Not resetting LM Studio instance: %d request(s) still in flight", _in_flight)
+            return
         reset_lm_studio_instance()
+
+def get_lm_studio_instance(config, count_in_flight=False):
+    """Get LM Studio instance (singleton pattern)
+
+    With count_in_flight, the returned instance is counted in _in_flight in the
+    same locked step that hands it out, so it cannot be reset before the caller
+    uses it; the caller must decrement _in_flight when done.
+    """
+    import lmstudio as lms  # Imported on first use; lmstudio pulls in heavy dependencies
+    global _lm_studio_instance, _last_connection_time, _in_flight
+    
+    for attempt in range(config['max_retries']):
+        with _lm_studio_lock:
+            current_time = time.time()
         
-        for attempt in range(config['max_retries']):
-            try:
-                # Configure client
-                lms.configure_default_client(config['base_url'])
-                model = lms.llm(config['model_name'])
-                _lm_studio_instance = model
-                _last_connection_time = current_time
-                logger.info(f"Connected to LM Studio (Attempt {attempt + 1}/{config['max_retries']})")
-                return _lm_studio_instance
-            except Exception as e:
-                if attempt < config['max_retries'] - 1:
-                    wait_time = config['retry_delay'] * (attempt + 1)
-                    logger.info(f"Connection failed, retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
+            # Check if reconnection is needed (an expired instance is kept while requests use it)
+            if (_lm_studio_instance is None or 
+                _last_connection_time is None or 
+                (current_time - _last_connection_time > _connection_timeout and not _in_flight)):
+            
+                # Reset existing instance
+                reset_lm_studio_instance()
+                try:
+                    # Configure client
+                    lms.configure_default_client(config['base_url'])
+                    _lm_studio_instance = lms.llm(config['model_name'])
+                    _last_connection_time = current_time
+                    logger.info("Connected to LM Studio (Attempt %d/%d)", attempt + 1, config['max_retries'])
+                except Exception:
                     reset_lm_studio_instance()
-                else:
-                    logger.error("Unable to establish connection")
-                    return None
+            
+            if _lm_studio_instance is not None:
+                if count_in_flight:
+                    _in_flight += 1
+                return _lm_studio_instance
+        
+        # Back off without holding the lock, so other requests aren't blocked meanwhile
+        if attempt < config['max_retries'] - 1:
+            wait_time = config['retry_delay'] * (attempt + 1)
+            logger.info("Connection failed, retrying in %s seconds...", wait_time)
+            time.sleep(wait_time)
     
-    return _lm_studio_instance
+    logger.error("Unable to establish connection")
+    return None
 
-def generate_prompt(content, prompt_template, config):
-    """Generate image prompt"""
-    for attempt in range(config['max_retries']):
+def _wait_completion(future, timeout, stop_event):
+    """Wait for a completion future, in 1-second slices while stop_event is given
+
+    Raises concurrent.futures.TimeoutError after timeout seconds, and
+    InterruptedError once stop_event is set.
+    """
+    if stop_event is None:
+        return future.result(timeout=timeout)
+    deadline = time.monotonic() + timeout
+    while not stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise concurrent.futures.TimeoutError
         try:
-            model = get_lm_studio_instance(config)
-            if model is None:
-                raise Exception("LM Studio model not initialized")
+            return future.result(timeout=min(1, remaining))
+        except concurrent.futures.TimeoutError:
+            continue
+    raise InterruptedError("Prompt generation cancelled")
 
+def generate_prompt(content, prompt_template, config, stop_event=None):
+    """Generate image prompt
+
+    Setting stop_event cancels the request and stops retrying (raises InterruptedError).
+    """
+    global _in_flight
+    cache_key = _prompt_cache_key(content, prompt_template, config)
+    with _prompt_cache_lock:
+        cached = _prompt_cache.get(cache_key)
+        if cached is not None:
+            _prompt_cache.move_to_end(cache_key)
+    if cached is not None:
+        logger.info("Using cached prompt for identical content")
+        return cached
+    
+    prompt = _render_template(prompt_template, content)
+    
+    for attempt in range(config['max_retries']):
+        try:
             # Set timeout (seconds)
             timeout = config.get('timeout', 30)
             
-            # Use thread to execute generation task
-            import threading
-            import queue
-            
-            result_queue = queue.Queue()
-            error_queue = queue.Queue()
-            
-            def generate_task():
+            # Counted as in flight as it is handed out, so it isn't reset while in use
+            model = get_lm_studio_instance(config, count_in_flight=True)
+            if model is None:
+                raise Exception("LM Studio model not initialized")
+
+            stuck = False
+            try:
+                # Stream the completion so a timed-out request can be cancelled on the server,
+                # and wait for it on a worker thread with a timeout. wait_for_result() starts
+                # the request and blocks until it finishes (result() does neither)
+                stream = model.complete_stream(prompt)
+                future = _submit_completion(stream.wait_for_result)
                 try:
-                    response = model.complete(prompt_template.format(content=content))
-                    result_queue.put(str(response).strip())
-                except Exception as e:
-                    error_queue.put(e)
-            
-            # Create and start generation thread
-            thread = threading.Thread(target=generate_task)
-            thread.daemon = True
-            thread.start()
-            
-            # Wait for result or timeout
-            thread.join(timeout)
-            
-            if thread.is_alive():
-                logger.error(f"Prompt generation timed out ({timeout} seconds)")
-                reset_lm_studio_instance()
-                raise Exception(f"Prompt generation timed out ({timeout} seconds)")
+                    response = _wait_completion(future, timeout, stop_event)
+                except InterruptedError:
+                    stream.cancel()
+                    raise
+                except concurrent.futures.TimeoutError:
+                    logger.error("Prompt generation timed out (%s seconds)", timeout)
+                    stream.cancel()
+                    try:
+                        future.result(timeout=_cancel_timeout)
+                    except concurrent.futures.TimeoutError:
+                        # The worker is still blocked on the request, so it is replaced
+                        stuck = True
+                        _abandon_completion(future)
+                    except Exception:
+                        pass  # Cancelled requests end with an error
+                    raise Exception(f"Prompt generation timed out ({timeout} seconds)")
+            finally:
+                with _lm_studio_lock:
+                    _in_flight -= 1
+                    if stuck:
+                        # Later calls need a fresh connection
+                        _reset_if_idle()
             
-            # Check for errors
-            if not error_queue.empty():
-                raise error_queue.get()
+            # Use the completion text directly instead of going through __str__
+            text = getattr(response, 'content', None) or getattr(response, 'text', None) or str(response)
+            result = text.strip()
             
-            # Get result
-            if result_queue.empty():
-                raise Exception("Prompt generation failed: No result received")
-                
-            result = result_queue.get()
-            reset_lm_studio_instance()
+            with _prompt_cache_lock:
+                _prompt_cache[cache_key] = result
+                if len(_prompt_cache) > _prompt_cache_size:
+                    _prompt_cache.popitem(last=False)
             return result
             
+        except InterruptedError:
+            raise
         except Exception as e:
             if attempt < config['max_retries'] - 1:
                 wait_time = config['retry_delay'] * (attempt + 1)
-                logger.info(f"Generation failed, retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+                logger.info("Generation failed, retrying in %s seconds...", wait_time)
+                if stop_event is None:
+                    time.sleep(wait_time)
+                elif stop_event.wait(wait_time):
+                    raise InterruptedError("Prompt generation cancelled")
                 if "ECONNRESET" in str(e) or "connection" in str(e).lower():
-                    reset_lm_studio_instance()
+                    _reset_if_idle()
             else:
                 raise Exception("Unable to generate prompt")
 
+def generate_prompts(contents, prompt_template, config):
+    """Generate image prompts for several contents concurrently
+
+    Requests share the LM Studio connection and run up to
+    config['parallelism'] at a time. Returns a list of prompts aligned with
+    contents (None for failed ones).
+    """
+    if not contents:
+        return []
+    
+    def generate_one(content):
+        try:
+            return generate_prompt(content, prompt_template, config)
+        except Exception as e:
+            logger.error("Error generating prompt: %s", e)
+            return None
+    
+    # Identical contents are only generated once; more requests than completion
+    # workers would only wait in their queue while their timeout runs
+    unique = list(dict.fromkeys(contents))
+    max_workers = min(len(unique), config.get('parallelism', 4), _completion_workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lms_batch') as executor:
+        results = dict(zip(unique, executor.map(generate_one, unique)))
+    return [results[content] for content in contents]
+
 def save_prompt(prompt_text, output_dir):
-    """Save generated prompt"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    os.makedirs(output_dir, exist_ok=True)
+    """Save generated prompt in the background
+
+    Returns (future, filename); the future completes once the file is written.
+    """
+    timestamp = make_timestamp()
+    ensure_dir(output_dir)
     
     filename = os.path.join(output_dir, f"prompt_{timestamp}.txt")
     
-    try:
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(prompt_text)
-        
-        logger.info(f"Prompt saved to: {filename}")
-        return filename
-    except Exception as e:
-        raise Exception(f"Error saving prompt: {str(e)}") 
\ No newline at end of file
+    future = write_text_async(filename, prompt_text)
+    
+    def report(future):
+        if future.exception():
+            logger.error("Error saving prompt: %s", future.exception())
+        else:
+            logger.info("Prompt saved to: %s", filename)
+    
+    future.add_done_callback(report)
+    return future, filename 
\ No newline at end of file
@@ -1,17 +1,123 @@
 import torch
-from faster_whisper import WhisperModel
+import numpy as np
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
 import logging
 import os
+import hashlib
+import functools
+import concurrent.futures
+from collections import deque
 from datetime import datetime
+from utils.file_utils import make_timestamp, ensure_dir, write_text_async
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['transcribe_audio', 'save_transcription', 'load_whisper_model']
+__all__ = ['transcribe_audio', 'transcribe_audio_batch', 'get_batched_pipeline', 'transcribe_batch', 'transcribe_stream', 'save_transcription', 'load_whisper_model']
+
+# Loaded models, keyed on (backend, model_name, device, configured compute_type)
+_model_cache = {}
+
+# Backend used when WHISPER_CONFIG has no 'backend'
+_DEFAULT_BACKEND = 'faster-whisper'
+
+# Batched inference pipeline, created once and reused across batches
+_batched_pipeline = None
+
+def _is_faster_whisper(config):
+    """Check whether the configured backend is faster-whisper (CTranslate2)"""
+    return config.get('backend', _DEFAULT_BACKEND) == 'faster-whisper'
+
+def _resolve_model_name(config, backend):
+    """Get the model to load for a backend
+
+    distil-whisper checkpoints on the Hugging Face Hub ("distil-whisper/distil-*")
+    are Transformers weights; for faster-whisper they map to their CTranslate2
+    conversions ("Systran/faster-distil-whisper-*").
+    """
+    model_name = config['model_name']
+    is_distil = model_name.startswith("distil-whisper/")
+    if is_distil and not hasattr(_resolve_model_name, '_distil_hint_logged'):
+        logger.info("Using distil-whisper: about 6x faster than large-v2 with <1% WER loss, English-only")
+        _resolve_model_name._distil_hint_logged = True
+    if backend == 'faster-whisper':
+        if is_distil:
+            return "Systran/faster-" + model_name.split("/", 1)[1].replace("distil-", "distil-whisper-", 1)
+        return model_name
+    # Transformers needs a Hugging Face checkpoint rather than a CTranslate2 conversion
+    if is_distil:
+        return model_name
+    return config.get('transformers_model', "openai/whisper-large-v3")
+
+def _load_faster_whisper(config, model_name, device):
+    """Load a CTranslate2 Whisper model with faster-whisper"""
+    # 8-bit weights halve the memory moved per decoder step with negligible accuracy loss
+    compute_type = config.get('compute_type', 'int8_float16' if device == "cuda" else 'int8')
+    return WhisperModel(
+        model_name,
+        device=device,
+        compute_type=compute_type,
+        device_index=0,
+        cpu_threads=4,
+        num_workers=config.get('num_workers', 4),
+        download_root=config['model_dir'],
+        local_files_only=False
+    )
+
+def _load_transformers(config, model_name, device, attention):
+    """Load a Hugging Face Transformers ASR pipeline (fp16 on GPU)
+
+    attention is "flash_attention_2" or "sdpa" (PyTorch's fused
+    scaled_dot_product_attention, which replaces BetterTransformer).
+    """
+    from transformers import pipeline  # Optional dependency, only needed for these backends
+    model_kwargs = {"cache_dir": config['model_dir'], "attn_implementation": attention}
+    return pipeline(
+        "automatic-speech-recognition",
+        model_name,
+        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+        device="cuda:0" if device == "cuda" else "cpu",
+        model_kwargs=model_kwargs
+    )
+
+# Model loaders by WHISPER_CONFIG['backend']
+_BACKENDS = {
+    'faster-whisper': _load_faster_whisper,
+    'transformers-fa2': functools.partial(_load_transformers, attention="flash_attention_2"),
+    'transformers-bt': functools.partial(_load_transformers, attention="sdpa"),
+}
+
+def _warm_up(model, config):
+    """Run one second of silence through a freshly loaded model, so the first transcription isn't slow"""
+    silence = np.zeros(16000, dtype=np.float32)
+    try:
+        if _is_faster_whisper(config):
+            # Segments are generated lazily, so consume them to actually decode
+            segments, _ = model.transcribe(silence, language=config['language'], beam_size=1, vad_filter=False)
+            list(segments)
+        else:
+            model(silence)
+        logger.info("Whisper model warmed up")
+    except Exception as e:
+        logger.warning(f"Whisper model warm-up failed: {e}")
 
 def load_whisper_model(config):
-    """Load Whisper model"""
+    """Load Whisper model (cached, so repeated calls reuse the loaded model)
+
+    Returns a faster-whisper WhisperModel, or a Transformers ASR pipeline for the
+    transformers-* backends.
+    """
+    backend = config.get('backend', _DEFAULT_BACKEND)
+    if backend not in _BACKENDS:
+        logger.error(f"Unknown Whisper backend: {backend}")
+        return None
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_name = _resolve_model_name(config, backend)
+    key = (backend, model_name, device, config.get('compute_type'))
+    if key in _model_cache:
+        return _model_cache[key]
+    
     try:
-        logger.info(f"Loading Whisper model {config['model_name']}...")
+        logger.info(f"Loading Whisper model {model_name} ({backend})...")
         
         # Only log GPU info on first load
         if not hasattr(load_whisper_model, '_gpu_info_logged'):
@@ -20,26 +126,106 @@ def load_whisper_model(config):
             load_whisper_model._gpu_info_logged = True
         
         # Initialize Whisper model
-        model = WhisperModel(
-            config['model_name'],
-            device="cuda" if torch.cuda.is_available() else "cpu",
-            compute_type="float16",
-            device_index=0,
-            cpu_threads=4,
-            num_workers=4,
-            download_root=config['model_dir'],
-            local_files_only=False
-        )
+        model = _BACKENDS[backend](config, model_name, device)
         
         logger.info("Whisper model loaded successfully")
+        if config.get('warmup', True):
+            _warm_up(model, config)
+        _model_cache[key] = model
         return model
         
     except Exception as e:
         logger.error(f"Unable to load Whisper model: {e}")
         return None
 
+def _load_audio(audio_path, config):
+    """Get the audio to pass to the model: the file path, or with feature_cache
+    enabled, the decoded 16 kHz mono float32 samples cached on disk
+
+    The cache is keyed on path, size and modification time, so re-running
+    transcription on the same file (e.g. while tuning decoding settings)
+    skips the ffmpeg decode and resampling.
+    """
+    if not config.get('feature_cache', False):
+        return audio_path
+    
+    stat = os.stat(audio_path)
+    key = hashlib.blake2b(
+        f"{os.path.abspath(audio_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8'),
+        digest_size=16
+    ).hexdigest()
+    cache_dir = os.path.join(config['model_dir'], 'audio_cache')
+    cache_file = os.path.join(cache_dir, f"{key}.npy")
+    try:
+        return np.load(cache_file)
+    except (OSError, ValueError):
+        pass
+    
+    audio = decode_audio(audio_path, sampling_rate=16000)
+    try:
+        ensure_dir(cache_dir)
+        np.save(cache_file, audio)
+    except OSError as e:
+        logger.warning(f"Unable to cache decoded audio for {audio_path}: {e}")
+    return audio
+
+def _transcribe_kwargs(config):
+    """Build the decoding parameters shared by single and batched transcription"""
+    return dict(
+        language=config['language'],
+        task=config['task'],
+        beam_size=config.get('beam_size', 1),
+        best_of=config.get('best_of', 1),
+        patience=1,
+        length_penalty=1.0,
+        repetition_penalty=1.0,
+        no_repeat_ngram_size=0,
+        temperature=config.get('temperature', 0.0),
+        compression_ratio_threshold=2.4,
+        log_prob_threshold=-1.0,
+        no_speech_threshold=0.3,
+        condition_on_previous_text=True,
+        word_timestamps=config.get('word_timestamps', False),
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=1000),
+        chunk_length=30,
+        max_new_tokens=128
+    )
+
+def _transformers_transcribe(pipe, audio_paths, config):
+    """Transcribe audio files with a Transformers ASR pipeline, batching 30-second chunks"""
+    results = pipe(
+        [_load_audio(audio_path, config) for audio_path in audio_paths],
+        chunk_length_s=config.get('chunk_length', 30),
+        batch_size=config.get('batch_size', 8),
+        generate_kwargs={"language": config['language'], "task": config['task']}
+    )
+    return [_result_to_text(result) for result in results]
+
+def _result_to_text(result):
+    """Extract text from a transcription result"""
+    # Handle different types of return results
+    if hasattr(result, 'text'):
+        return result.text.strip()
+    elif isinstance(result, tuple) and len(result) > 0:
+        segments = list(result[0])
+        if segments:
+            return " ".join(segment.text for segment in segments).strip()
+        else:
+            logger.warning("No speech segments detected")
+            return ""
+    elif isinstance(result, dict):
+        text = result.get('text', '')
+        return text.strip() if text else ""
+    else:
+        logger.warning(f"Unknown transcription result format: {type(result)}")
+        return str(result).strip()
+
 def transcribe_audio(audio_path, config):
     """Transcribe audio using Whisper"""
+    if not _is_faster_whisper(config):
+        return (transcribe_batch([audio_path], config) or [None])[0]
+    
     logger.info("Starting audio transcription...")
     model = load_whisper_model(config)
     if not model:
@@ -48,64 +234,190 @@ def transcribe_audio(audio_path, config):
     
     try:
         # Transcribe with optimized parameters
-        result = model.transcribe(
-            audio_path,
-            language=config['language'],
-            task=config['task'],
-            beam_size=8,
-            best_of=8,
-            patience=2,
-            length_penalty=1.0,
-            repetition_penalty=1.0,
-            no_repeat_ngram_size=0,
-            temperature=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0],
-            compression_ratio_threshold=2.4,
-            log_prob_threshold=-1.0,
-            no_speech_threshold=0.3,
-            condition_on_previous_text=True,
-            word_timestamps=True,
-            vad_filter=True,
-            vad_parameters=dict(min_silence_duration_ms=1000),
-            chunk_length=30,
-            max_new_tokens=128
-        )
-        
-        # Handle different types of return results
-        if hasattr(result, 'text'):
-            return result.text.strip()
-        elif isinstance(result, tuple) and len(result) > 0:
-            segments = list(result[0])
-            if segments:
-                return " ".join(segment.text for segment in segments).strip()
-            else:
-                logger.warning("No speech segments detected")
-                return ""
-        elif isinstance(result, dict):
-            text = result.get('text', '')
-            return text.strip() if text else ""
-        else:
-            logger.warning(f"Unknown transcription result format: {type(result)}")
-            return str(result).strip()
+        result = model.transcribe(_load_audio(audio_path, config), **_transcribe_kwargs(config))
+        return _result_to_text(result)
             
     except Exception as e:
         logger.error(f"Error during audio transcription: {e}")
         return None
 
+def transcribe_batch(audio_paths, config):
+    """Transcribe several audio files concurrently with one Whisper model
+
+    Each file runs on its own thread; the model's CTranslate2 workers
+    (num_workers) decode them in parallel. Returns a list of transcriptions
+    aligned with audio_paths (None for failed files).
+    """
+    if not audio_paths:
+        return []
+    logger.info(f"Starting concurrent audio transcription of {len(audio_paths)} file(s)...")
+    model = load_whisper_model(config)
+    if not model:
+        logger.error("Error: Unable to load Whisper model")
+        return [None] * len(audio_paths)
+    
+    if not _is_faster_whisper(config):
+        try:
+            return _transformers_transcribe(model, audio_paths, config)
+        except Exception as e:
+            logger.error(f"Error during audio transcription: {e}")
+            return [None] * len(audio_paths)
+    
+    kwargs = _transcribe_kwargs(config)
+    
+    def transcribe_one(audio_path):
+        try:
+            # Consume the segment generator on the worker thread so decoding happens there
+            return _result_to_text(model.transcribe(_load_audio(audio_path, config), **kwargs))
+        except Exception as e:
+            logger.error(f"Error during audio transcription of {audio_path}: {e}")
+            return None
+    
+    max_workers = min(len(audio_paths), config.get('num_workers', 4))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(transcribe_one, audio_paths))
+
+def transcribe_stream(audio_stream, config, sampling_rate=16000):
+    """Transcribe a stream of mono float32 audio blocks, yielding finalized text
+
+    Only a bounded window of audio is kept: after each decode, segments that end
+    more than stream_margin seconds before the end of the window are emitted as
+    final and their audio is trimmed from the buffer, so decode cost and memory
+    stay constant however long the session runs.
+    """
+    if not _is_faster_whisper(config):
+        logger.error("Stream transcription requires the faster-whisper backend")
+        return
+    
+    model = load_whisper_model(config)
+    if not model:
+        logger.error("Error: Unable to load Whisper model")
+        return
+    
+    kwargs = _transcribe_kwargs(config)
+    margin = config.get('stream_margin', 2.0)
+    step = int(config.get('stream_step', 1.0) * sampling_rate)
+    max_window = int(config.get('stream_window', 30) * sampling_rate)
+    
+    buffer = deque()
+    buffered = 0
+    pending = 0
+    
+    def trim(samples):
+        """Drop samples from the start of the buffer"""
+        nonlocal buffered
+        buffered -= samples
+        while samples:
+            block = buffer[0]
+            if len(block) <= samples:
+                buffer.popleft()
+                samples -= len(block)
+            else:
+                buffer[0] = block[samples:]
+                samples = 0
+    
+    def decode():
+        """Transcribe the current window"""
+        segments, _ = model.transcribe(np.concatenate(buffer), **kwargs)
+        return list(segments)
+    
+    for block in audio_stream:
+        buffer.append(np.asarray(block, dtype=np.float32).reshape(-1))
+        buffered += len(buffer[-1])
+        pending += len(buffer[-1])
+        if pending < step:
+            continue
+        pending = 0
+        
+        try:
+            segments = decode()
+        except Exception as e:
+            logger.error(f"Error during stream transcription: {e}")
+            continue
+        
+        window_end = buffered / sampling_rate
+        # Commit everything once the window is full, so it never grows past max_window
+        force = buffered >= max_window
+        committed = 0.0
+        for segment in segments:
+            if not force and segment.end > window_end - margin:
+                break
+            if segment.text.strip():
+                yield segment.text.strip()
+            committed = segment.end
+        if force:
+            committed = window_end
+        trim(min(buffered, int(committed * sampling_rate)))
+    
+    # Flush whatever is left at the end of the stream
+    if buffered:
+        try:
+            for segment in decode():
+                if segment.text.strip():
+                    yield segment.text.strip()
+        except Exception as e:
+            logger.error(f"Error during stream transcription: {e}")
+
+def get_batched_pipeline(config):
+    """Get the batched inference pipeline (created on first use)"""
+    global _batched_pipeline
+    if _batched_pipeline is None:
+        model = load_whisper_model(config)
+        if not model:
+            return None
+        # Transformers pipelines already batch; faster-whisper needs the batched wrapper
+        _batched_pipeline = BatchedInferencePipeline(model=model) if _is_faster_whisper(config) else model
+    return _batched_pipeline
+
+def transcribe_audio_batch(audio_paths, config):
+    """Transcribe several audio files through one batched Whisper pipeline
+
+    Returns a list of transcriptions aligned with audio_paths (None for failed files).
+    """
+    logger.info(f"Starting batched audio transcription of {len(audio_paths)} file(s)...")
+    pipeline = get_batched_pipeline(config)
+    if not pipeline:
+        logger.error("Error: Unable to load Whisper model")
+        return [None] * len(audio_paths)
+    
+    if not _is_faster_whisper(config):
+        return transcribe_batch(audio_paths, config)
+    
+    batch_size = config.get('batch_size', 8)
+    transcriptions = []
+    for audio_path in audio_paths:
+        try:
+            # The pipeline batches the speech chunks of each file on the GPU
+            result = pipeline.transcribe(_load_audio(audio_path, config), batch_size=batch_size, **_transcribe_kwargs(config))
+            transcriptions.append(_result_to_text(result))
+        except Exception as e:
+            logger.error(f"Error during audio transcription of {audio_path}: {e}")
+            transcriptions.append(None)
+    return transcriptions
+
 def save_transcription(text, audio_filename, output_dir):
-    """Save transcription text"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    os.makedirs(output_dir, exist_ok=True)
+    """Save transcription text in the background
+
+    Returns (future, filename); the future completes once the file is written.
+    """
+    timestamp = make_timestamp()
+    ensure_dir(output_dir)
     
     filename = os.path.join(output_dir, f"transcription_{timestamp}.txt")
     
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"Original audio file: {os.path.basename(audio_filename)}\n")
-            f.write(f"Transcription time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("\nTranscription content:\n")
-            f.write(text)
-        
-        logger.info(f"Transcription text saved to: {filename}")
-        return filename
-    except Exception as e:
-        raise Exception(f"Error saving transcription text: {str(e)}") 
\ No newline at end of file
+    future = write_text_async(
+        filename,
+        f"Original audio file: {os.path.basename(audio_filename)}\n"
+        f"Transcription time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        "\nTranscription content:\n"
+        + text
+    )
+    
+    def report(future):
+        if future.exception():
+            logger.error(f"Error saving transcription text: {future.exception()}")
+        else:
+            logger.info(f"Transcription text saved to: {filename}")
+    
+    future.add_done_callback(report)
+    return future, filename 
\ No newline at end of file